@@ -1,14 +1,23 @@
 import functools
+import math
+import os
+import pickle
+import re
+import string
+import threading
 import urllib.parse
 import contextvars
 import contextlib
 from urllib.parse import urlencode
 
 import httpx
+import orjson
+import pandas as pd
 import sqlalchemy as sa
 import sqlalchemy.engine.reflection
 import sqlalchemy.dialects.sqlite.base
 from ibis.backends.base.sql.alchemy import BaseAlchemyBackend
+from ibis.backends.base.sql.alchemy.geospatial import geospatial_supported
 from ibis.backends.sqlite.compiler import SQLiteCompiler
 
 
@@ -25,10 +34,105 @@ def cacheable():
         _cacheable.reset(t)
 
 
+def _loads(resp):
+    """Decode a JSON response body"""
+    try:
+        return orjson.loads(resp.content)
+    except orjson.JSONDecodeError:
+        # Python's json module (used by datasette) may emit non-standard
+        # values like `Infinity` that orjson rejects
+        return resp.json()
+
+
+_param_re = re.compile(r":(\w+)")
+
+# Integers outside this range are clamped by CAST(... AS INTEGER), but read as
+# REAL when written as a literal
+_INT64_MIN = -(2**63)
+_INT64_MAX = 2**63 - 1
+
+
+@functools.lru_cache(128)
+def _cast_numeric_params(statement, casts):
+    """Rewrite numeric parameters in a statement to be cast on the server.
+
+    XXX: datasette passes all parameters as strings. Numeric parameters are
+    cast back to numbers, with a unary + to strip the cast's affinity so
+    comparisons behave as they would against a numeric literal. This looks
+    worse than it is - the parameter names are auto-generated by sqlalchemy,
+    and are unlikely to collide with any embedded strings. Since the values
+    stay parameters the statement text is the same for any values, and a
+    single regex pass means `param_2` can never match part of `param_20`.
+    """
+    casts = dict(casts)
+
+    def replace(match):
+        name = match.group(1)
+        if name in casts:
+            return f"(+CAST(:{name} AS {casts[name]}))"
+        return match.group(0)
+
+    return _param_re.sub(replace, statement)
+
+
+@functools.lru_cache(128)
+def _encode_query(statement, params):
+    """Build the query string for a statement and its remaining parameters"""
+    query = dict(params)
+    query["sql"] = statement
+    # Request the arrays-of-arrays shape explicitly. It's the most compact
+    # shape datasette offers that preserves column order and duplicate
+    # column names (the `array`/`objects` shapes key rows by name).
+    query["_shape"] = "arrays"
+    return f"?{urlencode(query)}"
+
+
+# Successful bulk reflection results for immutable databases, keyed by cache
+# file path. Shared by every engine reflecting the same database contents.
+_persisted_caches = {}
+_persisted_lock = threading.Lock()
+
+# The content hashes datasette generates (sha256 hex digests)
+_hash_re = re.compile(r"[0-9a-f]{64}")
+
+
+def _reflection_cache_path(db_hash):
+    cache_dir = os.environ.get("IBIS_DATASETTE_CACHE_DIR")
+    if cache_dir is None:
+        cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+        cache_dir = os.path.join(cache_home, "ibis-datasette")
+    return os.path.join(cache_dir, f"{db_hash}.v1.pickle")
+
+
+def _load_reflection_cache(path):
+    try:
+        with open(path, "rb") as f:
+            cache = pickle.load(f)
+    except Exception:
+        # Missing or unreadable, start with an empty cache
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def _save_reflection_cache(path, cache):
+    if not cache:
+        return
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+
 class _Client:
     def __init__(self, client, base_url):
         self._client = client
         self._base_url = base_url
+        self._cache = {}
+        self._lock = threading.Lock()
 
     def _get(self, suffix):
         url = self._base_url + suffix
@@ -44,27 +148,45 @@ class _Client:
             raise
         return resp
 
-    @functools.lru_cache(32)
     def _cached_get(self, url):
-        return self._get(url)
+        with self._lock:
+            resp = self._cache.get(url)
+        if resp is None:
+            # Run the request outside the lock; concurrent misses for the same
+            # url may both hit the server, but the results are equivalent.
+            resp = self._get(url)
+            with self._lock:
+                self._cache[url] = resp
+        return resp
 
     def get(self, url):
         if _cacheable.get():
             return self._cached_get(url)
         return self._get(url)
 
+    def close(self):
+        with self._lock:
+            self._cache.clear()
+
 
 class Cursor:
     def __init__(self, conn):
         self._conn = conn
-        self._rows = None
+        self._rows = []
+        self._index = 0
         self._description = None
         self._next = None
+        self._truncated = False
 
     @property
     def rowcount(self):
         return -1
 
+    @property
+    def truncated(self):
+        """Whether the server truncated the results at ``max_returned_rows``"""
+        return self._truncated
+
     @property
     def description(self):
         return self._description
@@ -75,38 +197,42 @@ class Cursor:
     def _do_query(self, query_string):
         self._description = None
         self._next = None
-        self._rows = None
+        self._rows = []
+        self._index = 0
 
-        json = self._conn._get(query_string).json()
+        json = _loads(self._conn._get(query_string))
 
         self._description = [
             (col, None, None, None, None, None, None) for col in json["columns"]
         ]
+        self._load_page(json)
+
+    def _load_page(self, json):
+        # The columns are the same on every page, `_description` is only built
+        # from the first one in `_do_query`.
         self._next = json.get("next", None)
-        self._rows = iter(json.get("rows", []))
+        self._truncated = json.get("truncated", False)
+        self._rows = json.get("rows", [])
+        self._index = 0
 
-    def _next_row(self):
-        if self._rows is not None:
-            try:
-                return next(self._rows)
-            except StopIteration:
-                self._rows = None
+    def _next_page(self):
+        self._load_page(_loads(self._conn._get(f"?_next={self._next}&_shape=arrays")))
 
-        if self._next is None:
-            return None
-        self._do_query(f"?_next={self._next}")
-        if self._rows is not None:
-            try:
-                return next(self._rows)
-            except StopIteration:
-                self._rows = None
+    def _next_row(self):
+        while self._index >= len(self._rows):
+            if self._next is None:
+                return None
+            self._next_page()
+        row = self._rows[self._index]
+        self._index += 1
+        return row
 
     def execute(self, statement, parameters=None):
         # Skip pragmas
         if statement.lstrip().startswith("PRAGMA"):
             raise NotImplementedError("PRAGMA operations aren't supported")
 
-        query = {}
+        params = []
 
         if parameters:
             if isinstance(parameters, tuple):
@@ -114,27 +240,25 @@ class Cursor:
                     "qmark (?) style parametrized queries are not supported"
                 )
             else:
-                # XXX: Traverse in reverse order to ensure replacements don't
-                # ever conflict (if we replace param_2 before param_20, we can
-                # end up accidentally overwriting param_20). All of this is bad
-                # and hacky.
-                for k, v in sorted(parameters.items(), reverse=True):
+                casts = []
+                for k, v in sorted(parameters.items()):
                     if isinstance(v, bool):
                         v = int(v)
+                    if isinstance(v, float) and not math.isfinite(v):
+                        raise NotImplementedError(
+                            "Non-finite float parameters are not supported"
+                        )
                     if isinstance(v, (int, float)):
-                        # XXX: datasette doesn't handle numeric parameters. This
-                        # looks far worse than it actually is - the
-                        # parameter names are auto-generated by sqlalchemy, and
-                        # are unlikely to collide with any embedded strings.
-                        # Further, since we're only swapping in numeric values
-                        # SQL injection attacks shouldn't be possible. Still,
-                        # this is gross - it'd be good to improve it.
-                        statement = statement.replace(f":{k}", str(v))
-                    else:
-                        query[k] = v
-
-        query["sql"] = statement
-        self._do_query(f"?{urlencode(query)}")
+                        if isinstance(v, int) and _INT64_MIN <= v <= _INT64_MAX:
+                            casts.append((k, "INTEGER"))
+                        else:
+                            casts.append((k, "REAL"))
+                        v = str(v)
+                    params.append((k, v))
+                if casts:
+                    statement = _cast_numeric_params(statement, tuple(casts))
+
+        self._do_query(_encode_query(statement, tuple(params)))
 
     def executemany(self, statement, parameters=None):
         raise NotImplementedError(
@@ -146,20 +270,39 @@ class Cursor:
         return self._next_row()
 
     def fetchmany(self, size=None):
+        if not size:
+            return self.fetchall()
         out = []
-        if size:
-            for _ in range(size):
-                if row := self._next_row():
-                    out.append(row)
+        if size < 0:
             return out
-        return self.fetchall()
+        while True:
+            start = self._index
+            stop = start + size - len(out)
+            out.extend(self._rows[start:stop])
+            self._index = min(stop, len(self._rows))
+            if len(out) == size or self._next is None:
+                return out
+            self._next_page()
 
     def fetchall(self):
-        out = []
-        while row := self._next_row():
-            out.append(row)
+        start = self._index
+        # Pass an unread page through as is rather than copying it
+        out = self._rows[start:] if start else self._rows
+        self._rows = []
+        self._index = 0
+        while self._next is not None:
+            self._next_page()
+            out.extend(self._rows)
+            self._rows = []
         return out
 
+    def fetch_columns(self):
+        """Fetch all remaining rows, transposed into a list of columns"""
+        rows = self.fetchall()
+        if not rows:
+            return [()] * len(self._description or ())
+        return list(zip(*rows))
+
 
 class Connection:
     def __init__(self, client, base_url):
@@ -181,7 +324,30 @@ class Connection:
         pass
 
     def close(self):
-        pass
+        self._client.close()
+
+    def _get_database_hash(self):
+        """The content hash of an immutable database, or None if it has none"""
+        base, _, name = self._client._base_url.rpartition("/")
+        if name.endswith(".json"):
+            name = name[:-5]
+        try:
+            resp = self._client._client.get(f"{base}/-/databases.json")
+            resp.raise_for_status()
+            databases = _loads(resp)
+        except (httpx.HTTPError, ValueError):
+            return None
+        if not isinstance(databases, list):
+            return None
+        for db in databases:
+            if isinstance(db, dict) and db.get("route", db.get("name")) == name:
+                db_hash = db.get("hash")
+                # The hash names a local file, only accept what datasette
+                # generates
+                if isinstance(db_hash, str) and _hash_re.fullmatch(db_hash):
+                    return db_hash
+                return None
+        return None
 
 
 class DBAPI:
@@ -193,33 +359,238 @@ class DBAPI:
     Error = RuntimeError
 
 
+# Pragmas that are reflected for all objects at once, mapped to the types of
+# `sqlite_master` entries they apply to
+_BULK_PRAGMAS = {
+    "table_xinfo": "('table', 'view')",
+    "index_list": "('table', 'view')",
+    "foreign_key_list": "('table', 'view')",
+    "index_info": "('index')",
+}
+
+_ascii_lower = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+def _fold_case(name):
+    """Lowercase ASCII letters only, matching how SQLite compares names"""
+    return name.translate(_ascii_lower)
+
+
+@functools.lru_cache(256)
+def _table_sql_query(qtable):
+    return (
+        f"SELECT sql FROM sqlite_master WHERE name = {qtable} "
+        f"AND type in ('table', 'view')"
+    )
+
+
+@functools.lru_cache(256)
+def _table_pragma_query(pragma, qtable):
+    return f"SELECT * FROM pragma_{pragma}({qtable})"
+
+
 class IbisDatasetteDialect(sa.dialects.sqlite.base.SQLiteDialect):
     name = "datasette"
     driver = "ibis_datasette"
     supports_statement_cache = True
+    supports_sane_rowcount = False
+    supports_sane_multi_rowcount = False
 
     @functools.cached_property
     def httpx_client(self):
-        return httpx.Client(follow_redirects=True)
+        # A single client is shared by all connections from this dialect, so
+        # requests reuse pooled (and for HTTPS, multiplexed HTTP/2) connections
+        return httpx.Client(
+            follow_redirects=True,
+            http2=True,
+            limits=httpx.Limits(
+                max_keepalive_connections=8, max_connections=16, keepalive_expiry=60.0
+            ),
+            timeout=httpx.Timeout(30.0, connect=10.0),
+        )
 
     def connect(self, *args, **kwargs):
         return Connection(self.httpx_client, kwargs["url"])
 
     @classmethod
     def get_pool_class(cls, url):
-        return sa.pool.SingletonThreadPool
+        # Connections are stateless wrappers around a threadsafe httpx client,
+        # a single connection can be shared by all threads.
+        return sa.pool.StaticPool
 
     @staticmethod
     def dbapi():
         return DBAPI()
 
     def get_isolation_level(self, dbapi_conn):
-        return "SERIALIZABLE"
+        return "AUTOCOMMIT"
+
+    def set_isolation_level(self, dbapi_conn, level):
+        pass  # no-op, datasette queries are always read-only
+
+    _bulk_cache_path = None
+
+    def _get_bulk_cache(self, connection):
+        """The results of bulk reflection queries.
+
+        For immutable databases, successful results are loaded from (and saved
+        to) a cache on disk, so later sessions can skip the queries entirely.
+        The database hash is looked up once per engine, on the first bulk
+        reflection.
+        """
+        try:
+            return self._bulk_cache
+        except AttributeError:
+            pass
+        cache = {}
+        db_hash = connection.connection._get_database_hash()
+        if db_hash is not None:
+            path = _reflection_cache_path(db_hash)
+            with _persisted_lock:
+                persisted = _persisted_caches.get(path)
+                if persisted is None:
+                    persisted = _load_reflection_cache(path)
+                    _persisted_caches[path] = persisted
+                cache.update(persisted)
+            self._bulk_cache_path = path
+        self._bulk_cache = cache
+        return cache
+
+    def _save_bulk_cache(self):
+        if self._bulk_cache_path is None:
+            return
+        # Missing results (truncated at max_returned_rows, or errors) depend
+        # on the server rather than the database contents, don't persist them
+        results = {k: v for k, v in self._bulk_cache.items() if v is not None}
+        with _persisted_lock:
+            persisted = _persisted_caches[self._bulk_cache_path]
+            if results.keys() <= persisted.keys():
+                return
+            persisted.update(results)
+            _save_reflection_cache(self._bulk_cache_path, dict(persisted))
+
+    @functools.cached_property
+    def _quoted_identifiers(self):
+        return {}
+
+    def _quote_identifier(self, name):
+        try:
+            return self._quoted_identifiers[name]
+        except KeyError:
+            quoted = self.identifier_preparer.quote_identifier(name)
+            self._quoted_identifiers[name] = quoted
+            return quoted
+
+    def _bulk_query(self, connection, statement):
+        """Execute a query, returning None if it failed or was truncated"""
+        cursor = connection.connection.cursor()
+        try:
+            cursor.execute(statement)
+        except ValueError:
+            # An error from datasette (e.g. a view that no longer compiles),
+            # fallback to reflecting tables individually
+            return None
+        rows = cursor.fetchall()
+        return None if cursor.truncated else rows
+
+    def _get_all_tables(self, connection, schema=None):
+        """Fetch the type, sql, and columns of every table and view in one
+        request.
+
+        Returns a dict of case-folded name -> (name, type, sql), or None if
+        the schema couldn't be fetched in bulk. The columns are cached as the
+        bulk ``table_xinfo`` results.
+        """
+        if schema not in (None, "main"):
+            return None
+        cache = self._get_bulk_cache(connection)
+        if "sqlite_master" not in cache:
+            # The sql is only included with the first column of each table
+            rows = self._bulk_query(
+                connection,
+                "SELECT m.name, m.type, "
+                "CASE WHEN p.cid IS NULL OR p.cid = 0 THEN m.sql END, p.* "
+                "FROM sqlite_master AS m "
+                "LEFT JOIN pragma_table_xinfo(m.name) AS p "
+                "WHERE m.type in ('table', 'view')",
+            )
+            if rows is not None:
+                tables = {}
+                columns = {}
+                for name, type_, sql, *info in rows:
+                    key = _fold_case(name)
+                    if sql is not None or key not in tables:
+                        tables[key] = (name, type_, sql)
+                    if info[0] is not None:
+                        columns.setdefault(key, []).append(info)
+                cache["table_xinfo"] = columns
+            else:
+                # Too many columns to fetch along with the tables (or an error
+                # reflecting them), fallback to listing only the tables. The
+                # columns are then fetched separately by `_get_all_pragma`.
+                rows = self._bulk_query(
+                    connection,
+                    "SELECT name, type, sql FROM sqlite_master "
+                    "WHERE type in ('table', 'view')",
+                )
+                if rows is not None:
+                    tables = {_fold_case(row[0]): tuple(row) for row in rows}
+                else:
+                    tables = None
+            cache["sqlite_master"] = tables
+            self._save_bulk_cache()
+        return cache["sqlite_master"]
+
+    def _get_all_pragma(self, connection, pragma, schema=None):
+        """Fetch the results of a pragma for every table (or index) in one
+        request.
+
+        Returns a dict of case-folded name -> rows, or None if the pragma
+        couldn't be fetched in bulk.
+        """
+        if schema not in (None, "main"):
+            return None
+        if pragma == "table_xinfo":
+            # Fetched along with the table listing
+            self._get_all_tables(connection)
+        cache = self._get_bulk_cache(connection)
+        if pragma not in cache:
+            rows = self._bulk_query(
+                connection,
+                f"SELECT m.name, p.* FROM sqlite_master AS m "
+                f"JOIN pragma_{pragma}(m.name) AS p "
+                f"WHERE m.type in {_BULK_PRAGMAS[pragma]}",
+            )
+            if rows is not None:
+                out = {}
+                for row in rows:
+                    out.setdefault(_fold_case(row[0]), []).append(row[1:])
+                rows = out
+            cache[pragma] = rows
+            self._save_bulk_cache()
+        return cache[pragma]
+
+    @sa.engine.reflection.cache
+    def get_table_names(self, connection, schema=None, **kw):
+        tables = self._get_all_tables(connection, schema=schema)
+        if tables is None:
+            return super().get_table_names(connection, schema=schema, **kw)
+        return sorted(name for name, type_, _ in tables.values() if type_ == "table")
+
+    @sa.engine.reflection.cache
+    def get_view_names(self, connection, schema=None, **kw):
+        tables = self._get_all_tables(connection, schema=schema)
+        if tables is None:
+            return super().get_view_names(connection, schema=schema, **kw)
+        return sorted(name for name, type_, _ in tables.values() if type_ == "view")
 
     @sa.engine.reflection.cache
     def has_table(self, connection, table_name, schema=None, **kw):
         self._ensure_has_table_connection(connection)
 
+        tables = self._get_all_tables(connection, schema=schema)
+        if tables is not None:
+            return _fold_case(table_name) in tables
         info = self._get_table_pragma(
             connection, "table_xinfo", table_name, schema=schema
         )
@@ -227,20 +598,23 @@ class IbisDatasetteDialect(sa.dialects.sqlite.base.SQLiteDialect):
 
     @sa.engine.reflection.cache
     def _get_table_sql(self, connection, table_name, schema=None, **kw):
-        qtable = self.identifier_preparer.quote_identifier(table_name)
-        s = (
-            f"SELECT sql FROM sqlite_master WHERE name = {qtable} "
-            f"AND type in ('table', 'view')"
-        )
-        with cacheable():
-            value = connection.exec_driver_sql(s).scalar()
+        tables = self._get_all_tables(connection, schema=schema)
+        if tables is not None:
+            value = tables.get(_fold_case(table_name), (None, None, None))[2]
+        else:
+            s = _table_sql_query(self._quote_identifier(table_name))
+            with cacheable():
+                value = connection.exec_driver_sql(s).scalar()
         if value is None and not self._is_sys_table(table_name):
             raise sa.exc.NoSuchTableError(table_name)
         return value
 
     def _get_table_pragma(self, connection, pragma, table_name, schema=None):
-        qtable = self.identifier_preparer.quote_identifier(table_name)
-        s = f"SELECT * FROM pragma_{pragma}({qtable})"
+        if pragma in _BULK_PRAGMAS:
+            info = self._get_all_pragma(connection, pragma, schema=schema)
+            if info is not None:
+                return info.get(_fold_case(table_name), [])
+        s = _table_pragma_query(pragma, self._quote_identifier(table_name))
         with cacheable():
             return connection.exec_driver_sql(s).fetchall()
 
@@ -255,6 +629,9 @@ class IbisDatasetteDialect(sa.dialects.sqlite.base.SQLiteDialect):
     def do_begin(self, connection):
         pass  # no-op
 
+    def do_commit(self, connection):
+        pass  # no-op
+
 
 sa.dialects.registry.register(
     "ibisdatasette", "ibis_datasette.core", "IbisDatasetteDialect"
@@ -288,11 +665,15 @@ class Backend(BaseAlchemyBackend):
             url += ".json"
 
         query = urllib.parse.urlencode({"url": url})
-        engine = sa.create_engine(url=f"ibisdatasette://?{query}")
+        engine = sa.create_engine(
+            url=f"ibisdatasette://?{query}",
+            isolation_level="AUTOCOMMIT",
+            pool_reset_on_return=None,
+        )
 
         with engine.dialect.connect(url=url) as con:
             resp = con._get("")
-            json = resp.json()
+            json = _loads(resp)
 
             if not json.get("allow_execute_sql", False):
                 raise ValueError(
@@ -304,6 +685,29 @@ class Backend(BaseAlchemyBackend):
         super().do_connect(engine)
         self._meta = sa.MetaData(bind=self.con)
 
+    def fetch_from_cursor(self, cursor, schema):
+        dbapi_cursor = cursor.cursor
+        processors = getattr(cursor._metadata, "_processors", None)
+        if (
+            not isinstance(dbapi_cursor, Cursor)
+            or processors is None
+            or any(processors)
+        ):
+            # Columns with result processors (dates, decimals, booleans, ...)
+            # need converting row by row, leave those to the base implementation
+            return super().fetch_from_cursor(cursor, schema)
+        # Build the frame column-wise straight from the decoded rows, skipping
+        # the per-row overhead of iterating through the sqlalchemy result.
+        names = cursor.keys()
+        columns = dbapi_cursor.fetch_columns()
+        cursor.close()
+        df = pd.DataFrame(dict(enumerate(columns)))
+        df.columns = names
+        df = schema.apply_to(df)
+        if len(df) and geospatial_supported:
+            return self._to_geodataframe(df, schema)
+        return df
+
     def _get_sqla_table(self, name, schema=None, autoload=True):
         return sa.Table(
             name,
@@ -4,7 +4,7 @@ import versioneer
 from setuptools import setup
 
 
-install_requires = ["httpx", "ibis-framework", "sqlalchemy"]
+install_requires = ["httpx[http2]", "ibis-framework", "orjson", "sqlalchemy"]
 
 
 setup(
@@ -1,14 +1,34 @@
+import concurrent.futures
 import functools
 import operator
+import pickle
 import random
+import shutil
 import sqlite3
 import string
 import subprocess
 import time
+import urllib.parse
 
+import httpx
+import pandas.testing as tm
 import pytest
+import sqlalchemy as sa
 import ibis
 from ibis import _
+from ibis.backends.base.sql.alchemy import BaseAlchemyBackend
+
+from ibis_datasette.core import (
+    Backend,
+    Connection,
+    Cursor,
+    IbisDatasetteDialect,
+    _cast_numeric_params,
+    _fold_case,
+    _load_reflection_cache,
+    _loads,
+    _save_reflection_cache,
+)
 
 
 def randstr():
@@ -66,19 +86,138 @@ def database(tmp_path_factory):
 
 
 @pytest.fixture(scope="session")
-def datasette(database):
+def reflection_database(database):
+    # Tables with indexes, constraints, and a view for testing reflection.
+    # Stored next to `database` so both are served together.
+    path = database.replace("test.db", "reflection.db")
+    con = sqlite3.connect(path)
+    with con:
+        con.execute("CREATE TABLE parent (id INTEGER PRIMARY KEY, name TEXT UNIQUE)")
+        con.execute(
+            "CREATE TABLE child ("
+            "id INTEGER PRIMARY KEY, "
+            "parent_id INTEGER REFERENCES parent(id), "
+            "label TEXT NOT NULL, "
+            "score REAL, "
+            "UNIQUE (label, score))"
+        )
+        con.execute("CREATE INDEX child_parent ON child (parent_id)")
+        con.execute(
+            "CREATE VIEW child_view AS SELECT child.label, parent.name "
+            "FROM child JOIN parent ON child.parent_id = parent.id"
+        )
+        con.executemany(
+            "INSERT INTO parent VALUES (?, ?)",
+            [(i, name) for i, name in enumerate(NAMES)],
+        )
+        con.executemany(
+            "INSERT INTO child VALUES (?, ?, ?, ?)",
+            [(i, i % len(NAMES), randstr(), random.random()) for i in range(100)],
+        )
+    con.close()
+    return path
+
+
+@pytest.fixture(scope="session")
+def broken_database(database):
+    # A database with a view over a dropped table, which errors when the view
+    # is reflected
+    path = database.replace("test.db", "broken.db")
+    con = sqlite3.connect(path)
+    with con:
+        con.execute("CREATE TABLE good (x INTEGER PRIMARY KEY, y TEXT UNIQUE)")
+        con.execute("CREATE TABLE dropped (x INTEGER)")
+        con.execute("CREATE VIEW bad_view AS SELECT x FROM dropped")
+        con.execute("DROP TABLE dropped")
+    con.close()
+    return path
+
+
+@pytest.fixture(scope="session")
+def immutable_database(reflection_database):
+    # A copy of `reflection_database` served as immutable, so it has a
+    # content hash
+    path = reflection_database.replace("reflection.db", "immutable.db")
+    shutil.copy(reflection_database, path)
+    return path
+
+
+@pytest.fixture(scope="session")
+def types_database(database):
+    # Tables for testing how values and parameters of each type round trip
+    path = database.replace("test.db", "types.db")
+    con = sqlite3.connect(path)
+    with con:
+        # Numbers stored as text, for testing numeric parameter comparisons
+        con.execute("CREATE TABLE text_numbers (x TEXT)")
+        con.executemany(
+            "INSERT INTO text_numbers VALUES (?)",
+            [("5",), ("5.0",), ("9",), ("10",), ("9223372036854775807",), ("abc",)],
+        )
+
+        # Types that sqlalchemy converts when reading results
+        con.execute(
+            "CREATE TABLE typed ("
+            "d DATE, ts TIMESTAMP, b BOOLEAN, n DECIMAL(10, 2), "
+            "i INTEGER, r REAL, s TEXT)"
+        )
+        con.executemany(
+            "INSERT INTO typed VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    f"2022-01-{i % 28 + 1:02d}",
+                    f"2022-01-{i % 28 + 1:02d} 12:{i % 60:02d}:30.000000",
+                    i % 2,
+                    i / 8,
+                    i,
+                    i / 3,
+                    randname(),
+                )
+                for i in range(50)
+            ]
+            + [(None,) * 7],
+        )
+    con.close()
+    return path
+
+
+@pytest.fixture(scope="session")
+def datasette(
+    tmp_path_factory,
+    database,
+    reflection_database,
+    broken_database,
+    immutable_database,
+    types_database,
+):
+    # Log to a file - an unread pipe fills up and stalls the server
+    log = open(tmp_path_factory.mktemp("logs") / "datasette.log", "w+b")
     ds_proc = subprocess.Popen(
-        ["datasette", "serve", "-p", "8041", database],
-        stdout=subprocess.PIPE,
+        [
+            "datasette",
+            "serve",
+            "-p",
+            "8041",
+            database,
+            reflection_database,
+            broken_database,
+            types_database,
+            "-i",
+            immutable_database,
+        ],
+        stdout=log,
         stderr=subprocess.STDOUT,
     )
     # Give the server time to start
     time.sleep(1.5)
     # Check it started successfully
-    assert not ds_proc.poll(), ds_proc.stdout.read().decode("utf-8")
+    if ds_proc.poll() is not None:
+        log.seek(0)
+        pytest.fail(log.read().decode("utf-8"))
     yield "http://127.0.0.1:8041"
     # Shut it down at the end of the pytest session
     ds_proc.terminate()
+    log.close()
 
 
 @pytest.fixture
@@ -86,6 +225,41 @@ def url(datasette):
     return datasette + "/test"
 
 
+@pytest.fixture
+def reflection_url(datasette):
+    return datasette + "/reflection"
+
+
+@pytest.fixture
+def types_url(datasette):
+    return datasette + "/types"
+
+
+REFLECTION_METHODS = [
+    "get_columns",
+    "get_pk_constraint",
+    "get_foreign_keys",
+    "get_indexes",
+    "get_unique_constraints",
+]
+
+
+def reflect(engine, name):
+    """Reflect everything about a table, in a form that's easy to compare"""
+    inspector = sa.inspect(engine)
+    info = {
+        method: repr(getattr(inspector, method)(name)) for method in REFLECTION_METHODS
+    }
+    table = sa.Table(name, sa.MetaData(), autoload_with=engine)
+    dialect = sa.dialects.sqlite.dialect()
+    info["ddl"] = str(sa.schema.CreateTable(table).compile(dialect=dialect))
+    info["indexes"] = sorted(
+        str(sa.schema.CreateIndex(index).compile(dialect=dialect))
+        for index in table.indexes
+    )
+    return info
+
+
 def test_connect_errors_not_database_url(datasette):
     with pytest.raises(ValueError, match="`connect` expects"):
         ibis.datasette.connect(datasette)
@@ -102,6 +276,209 @@ def test_list_tables(url):
     assert tables == ["table1", "table2"]
 
 
+@pytest.mark.parametrize("name", ["parent", "child", "child_view"])
+def test_reflection_matches_sqlite(reflection_url, reflection_database, name):
+    con = ibis.datasette.connect(reflection_url)
+    expected = reflect(sa.create_engine(f"sqlite:///{reflection_database}"), name)
+    assert reflect(con.con, name) == expected
+    # Reflection was served from the bulk queries
+    assert all(v is not None for v in con.con.dialect._bulk_cache.values())
+
+
+def test_reflection_bulk_pragmas(reflection_url):
+    con = ibis.datasette.connect(reflection_url)
+    reflect(con.con, "child")
+    # Every pragma used to reflect a table was fetched in bulk
+    assert sorted(con.con.dialect._bulk_cache) == [
+        "foreign_key_list",
+        "index_info",
+        "index_list",
+        "sqlite_master",
+        "table_xinfo",
+    ]
+
+
+def test_reflection_truncated_fallback(
+    reflection_url, reflection_database, monkeypatch
+):
+    # Pretend every result was truncated at max_returned_rows
+    monkeypatch.setattr(Cursor, "truncated", property(lambda self: True))
+    con = ibis.datasette.connect(reflection_url)
+    engine = sa.create_engine(f"sqlite:///{reflection_database}")
+    assert sorted(con.list_tables()) == sorted(
+        sa.inspect(engine).get_table_names() + sa.inspect(engine).get_view_names()
+    )
+    for name in ["parent", "child", "child_view"]:
+        assert reflect(con.con, name) == reflect(engine, name)
+    # Nothing was served from the bulk queries
+    assert all(v is None for v in con.con.dialect._bulk_cache.values())
+
+
+def test_reflection_join_truncated_fallback(
+    reflection_url, reflection_database, monkeypatch
+):
+    # Pretend only the combined tables and columns listing was truncated
+    bulk_query = IbisDatasetteDialect._bulk_query
+
+    def _bulk_query(self, connection, statement):
+        if "LEFT JOIN pragma_table_xinfo" in statement:
+            return None
+        return bulk_query(self, connection, statement)
+
+    monkeypatch.setattr(IbisDatasetteDialect, "_bulk_query", _bulk_query)
+    con = ibis.datasette.connect(reflection_url)
+    engine = sa.create_engine(f"sqlite:///{reflection_database}")
+    for name in ["parent", "child", "child_view"]:
+        assert reflect(con.con, name) == reflect(engine, name)
+    # The tables and columns were still fetched in bulk, just separately
+    assert con.con.dialect._bulk_cache["sqlite_master"] is not None
+    assert con.con.dialect._bulk_cache["table_xinfo"] is not None
+
+
+def test_reflection_error_fallback(datasette, broken_database):
+    # Bulk pragma queries over the broken view error on the server
+    con = ibis.datasette.connect(datasette + "/broken")
+    assert sorted(con.list_tables()) == ["bad_view", "good"]
+    engine = sa.create_engine(f"sqlite:///{broken_database}")
+    assert reflect(con.con, "good") == reflect(engine, "good")
+    # The tables are still listed in bulk
+    assert con.con.dialect._bulk_cache["sqlite_master"] is not None
+    assert con.con.dialect._bulk_cache["table_xinfo"] is None
+
+
+def test_has_table(reflection_url):
+    con = ibis.datasette.connect(reflection_url)
+    inspector = sa.inspect(con.con)
+    assert inspector.has_table("parent")
+    assert inspector.has_table("PARENT")
+    assert inspector.has_table("child_view")
+    assert not inspector.has_table("missing")
+    # Answered from the table listing, which also fetched the columns ready
+    # for autoloading
+    assert con.con.dialect._bulk_cache["table_xinfo"] is not None
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("IBIS_DATASETTE_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr("ibis_datasette.core._persisted_caches", {})
+    return tmp_path
+
+
+def test_reflection_cache_roundtrip(tmp_path):
+    path = str(tmp_path / "nested" / "cache.pickle")
+    assert _load_reflection_cache(path) == {}
+    cache = {"sqlite_master": {"t": ("t", "table", "CREATE TABLE t (x)")}}
+    _save_reflection_cache(path, cache)
+    assert _load_reflection_cache(path) == cache
+
+
+def test_reflection_cache_invalid(tmp_path):
+    path = tmp_path / "cache.pickle"
+    path.write_bytes(b"not a pickle")
+    assert _load_reflection_cache(str(path)) == {}
+    path.write_bytes(pickle.dumps(["not", "a", "dict"]))
+    assert _load_reflection_cache(str(path)) == {}
+
+
+@pytest.mark.parametrize(
+    "db_hash, valid",
+    [
+        ("0123456789abcdef" * 4, True),
+        ("0123456789ABCDEF" * 4, False),
+        ("0123456789abcdef" * 3, False),
+        ("../" * 10 + "etc/passwd", False),
+        ("0123456789abcdef" * 4 + "/../x", False),
+        (1234, False),
+        (None, False),
+    ],
+)
+def test_database_hash(db_hash, valid):
+    requests = []
+
+    def handler(request):
+        requests.append(request.url.path)
+        return httpx.Response(200, json=[{"name": "db", "hash": db_hash}])
+
+    client = httpx.Client(transport=httpx.MockTransport(handler))
+    expected = db_hash if valid else None
+    assert Connection(client, "http://example.com/db.json")._get_database_hash() == (
+        expected
+    )
+    # Not remembered across connections, a republished database gets a new hash
+    assert Connection(client, "http://example.com/db.json")._get_database_hash() == (
+        expected
+    )
+    assert requests == ["/-/databases.json"] * 2
+
+
+def test_mutable_database_not_persisted(reflection_url, cache_dir):
+    con = ibis.datasette.connect(reflection_url)
+    con.table("child")
+    assert con.con.dialect._bulk_cache
+    assert con.con.dialect._bulk_cache_path is None
+    assert not list(cache_dir.iterdir())
+
+
+def test_immutable_database_persisted(
+    datasette, reflection_database, cache_dir, monkeypatch
+):
+    url = datasette + "/immutable"
+    engine = sa.create_engine(f"sqlite:///{reflection_database}")
+
+    get_database_hash = Connection._get_database_hash
+    lookups = []
+
+    def _get_database_hash(self):
+        lookups.append(self)
+        return get_database_hash(self)
+
+    monkeypatch.setattr(Connection, "_get_database_hash", _get_database_hash)
+    con = ibis.datasette.connect(url)
+    for name in ["parent", "child", "child_view"]:
+        assert reflect(con.con, name) == reflect(engine, name)
+    # Looked up once for the engine
+    assert len(lookups) == 1
+    (path,) = cache_dir.iterdir()
+    assert _load_reflection_cache(str(path)) == con.con.dialect._bulk_cache
+
+    # A later session loads the results from disk, without any bulk queries
+    monkeypatch.setattr("ibis_datasette.core._persisted_caches", {})
+
+    def _bulk_query(self, connection, statement):
+        raise AssertionError("bulk reflection results should be cached")
+
+    monkeypatch.setattr(IbisDatasetteDialect, "_bulk_query", _bulk_query)
+    con = ibis.datasette.connect(url)
+    assert reflect(con.con, "child") == reflect(engine, "child")
+    # A new engine looks up the hash again
+    assert len(lookups) == 2
+
+
+def test_missing_bulk_results_not_persisted(datasette, cache_dir, monkeypatch):
+    url = datasette + "/immutable"
+    with monkeypatch.context() as m:
+        m.setattr(Cursor, "truncated", property(lambda self: True))
+        con = ibis.datasette.connect(url)
+        con.table("child")
+        assert all(v is None for v in con.con.dialect._bulk_cache.values())
+    assert not list(cache_dir.iterdir())
+
+    # A later session without truncation still fetches in bulk
+    con = ibis.datasette.connect(url)
+    con.table("child")
+    assert all(v is not None for v in con.con.dialect._bulk_cache.values())
+    (path,) = cache_dir.iterdir()
+    assert _load_reflection_cache(str(path)) == con.con.dialect._bulk_cache
+
+
+def test_fold_case():
+    # SQLite only ignores the case of ASCII characters in names
+    assert _fold_case("MixedCase") == "mixedcase"
+    assert _fold_case("\xc9t\xc9") == "\xc9t\xc9"
+    assert _fold_case("\xc9") != _fold_case("\xe9")
+
+
 def test_access_table(url):
     con = ibis.datasette.connect(url)
     t1 = con.tables.table1
@@ -156,6 +533,110 @@ def test_many_query_parameters(url):
     assert out == 30
 
 
+LARGE_INTS = [2**63 - 1, 2**63, -(2**63), -(2**63) - 1, 12345678901234567890]
+
+
+@pytest.mark.parametrize("op", ["=", "<", ">"])
+@pytest.mark.parametrize("value", [5, 5.0, 9.5, 10, -1, *LARGE_INTS])
+def test_numeric_query_parameters_text_column(types_url, types_database, op, value):
+    # Parameters should compare against a TEXT column like a numeric literal
+    query = f"SELECT x FROM text_numbers WHERE x {op} :p ORDER BY x"
+    con = ibis.datasette.connect(types_url)
+    res = con.con.execute(sa.text(query), {"p": value}).fetchall()
+    sqlite_con = sqlite3.connect(types_database)
+    expected = sqlite_con.execute(query.replace(":p", repr(value))).fetchall()
+    sqlite_con.close()
+    assert [tuple(r) for r in res] == expected
+
+
+@pytest.mark.parametrize("value", LARGE_INTS)
+def test_large_int_query_parameters(url, value):
+    # Integers outside int64 behave like the REAL literal sqlite parses them as
+    query = (
+        "SELECT :p, typeof(:p), :p > 9223372036854775807, "
+        ":p < -9223372036854775808, :p = 12345678901234567890"
+    )
+    con = ibis.datasette.connect(url)
+    res = con.con.execute(sa.text(query), {"p": value}).fetchall()
+    sqlite_con = sqlite3.connect(":memory:")
+    expected = sqlite_con.execute(query.replace(":p", f"({value!r})")).fetchall()
+    sqlite_con.close()
+    assert [tuple(r) for r in res] == expected
+
+
+def test_cast_numeric_params_prefix_names():
+    statement = "SELECT :param_2, :param_20, :param_2"
+    assert _cast_numeric_params(statement, (("param_2", "INTEGER"),)) == (
+        "SELECT (+CAST(:param_2 AS INTEGER)), :param_20, "
+        "(+CAST(:param_2 AS INTEGER))"
+    )
+    assert _cast_numeric_params(statement, (("param_20", "REAL"),)) == (
+        "SELECT :param_2, (+CAST(:param_20 AS REAL)), :param_2"
+    )
+
+
+def test_query_parameters_prefix_names(url):
+    con = ibis.datasette.connect(url)
+    res = con.con.execute(
+        sa.text("SELECT :param_2, typeof(:param_2), :param_20, typeof(:param_20)"),
+        {"param_2": 2, "param_20": "20"},
+    ).fetchall()
+    assert [tuple(r) for r in res] == [(2, "integer", "20", "text")]
+
+
+@pytest.mark.parametrize("value", [float("inf"), float("-inf"), float("nan")])
+def test_non_finite_query_parameters(value):
+    cursor = Cursor(FakeConnection())
+    with pytest.raises(NotImplementedError, match="Non-finite"):
+        cursor.execute("SELECT x FROM t WHERE x < :p", {"p": value})
+
+
+def test_concurrent_queries(url):
+    con = ibis.datasette.connect(url)
+    t1 = con.tables.table1
+    exprs = [t1.filter(t1.col3 == i).count() for i in range(20)]
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(lambda expr: expr.execute(), exprs))
+    assert results == [expr.execute() for expr in exprs]
+
+
+@pytest.mark.parametrize(
+    "columns, fast",
+    [
+        (lambda t: [t.i, t.r, t.s], True),
+        (lambda t: [(t.i / 3).name("x"), (t.i * 2).name("y")], True),
+        (lambda t: [t.d, t.ts, t.b, t.n, t.i, t.r, t.s], False),
+        (lambda t: [t.d], False),
+        (lambda t: [t.ts], False),
+        (lambda t: [t.b], False),
+        (lambda t: [t.n], False),
+        (lambda t: [t.i.cast("decimal(10, 2)").name("x")], False),
+        (lambda t: [(t.i / 3).cast("decimal(10, 2)").name("x")], False),
+    ],
+)
+def test_fetch_matches_from_records(types_url, monkeypatch, columns, fast):
+    con = ibis.datasette.connect(types_url)
+    t = con.tables.typed
+    expr = t[columns(t)]
+
+    fetch_columns = Cursor.fetch_columns
+    calls = []
+
+    def spy(self):
+        calls.append(self)
+        return fetch_columns(self)
+
+    monkeypatch.setattr(Cursor, "fetch_columns", spy)
+    res = expr.execute()
+    assert bool(calls) == fast
+
+    monkeypatch.setattr(
+        Backend, "fetch_from_cursor", BaseAlchemyBackend.fetch_from_cursor
+    )
+    sol = expr.execute()
+    tm.assert_frame_equal(res, sol)
+
+
 def test_string_query_parameters(url):
     con = ibis.datasette.connect(url)
     t1 = con.tables.table1
@@ -166,3 +647,91 @@ def test_api_error_raised(url):
     con = ibis.datasette.connect(url)
     with pytest.raises(ValueError, match="missing"):
         con.raw_sql("SELECT * FROM missing")
+
+
+class FakeConnection:
+    """A fake Connection serving paginated results with `next` tokens"""
+
+    def __init__(self, npages=3, page_size=4):
+        self.npages = npages
+        self.page_size = page_size
+        self.requests = []
+
+    def _get(self, suffix):
+        self.requests.append(suffix)
+        query = urllib.parse.parse_qs(suffix[1:])
+        page = int(query.get("_next", ["0"])[0])
+        start = page * self.page_size
+        json = {
+            "columns": ["x"],
+            "rows": [[i] for i in range(start, start + self.page_size)],
+        }
+        if page + 1 < self.npages:
+            json["next"] = str(page + 1)
+        return httpx.Response(200, json=json)
+
+
+def test_cursor_pagination():
+    conn = FakeConnection()
+    cursor = Cursor(conn)
+    cursor.execute("SELECT x FROM t")
+    assert cursor.description == [("x", None, None, None, None, None, None)]
+    assert cursor.fetchone() == [0]
+    assert cursor.fetchmany(5) == [[i] for i in range(1, 6)]
+    assert cursor.fetchall() == [[i] for i in range(6, 12)]
+    assert cursor.fetchone() is None
+    assert cursor.fetchmany(5) == []
+    assert [urllib.parse.parse_qs(r[1:]).get("_next") for r in conn.requests] == [
+        None,
+        ["1"],
+        ["2"],
+    ]
+
+
+def test_cursor_fetchmany_sizes():
+    cursor = Cursor(FakeConnection())
+    cursor.execute("SELECT x FROM t")
+    assert cursor.fetchmany(-1) == []
+    assert cursor.fetchmany(4) == [[i] for i in range(4)]
+    assert cursor.fetchmany(20) == [[i] for i in range(4, 12)]
+
+    cursor.execute("SELECT x FROM t")
+    assert cursor.fetchmany(0) == [[i] for i in range(12)]
+
+
+def test_cursor_fetchall_passes_page_through():
+    cursor = Cursor(FakeConnection())
+    cursor.execute("SELECT x FROM t")
+    page = cursor._rows
+    out = cursor.fetchall()
+    assert out is page
+    assert out == [[i] for i in range(12)]
+    assert cursor.fetchone() is None
+    assert cursor.fetchall() == []
+    assert out == [[i] for i in range(12)]
+
+
+def test_cursor_description_built_once():
+    cursor = Cursor(FakeConnection())
+    cursor.execute("SELECT x FROM t")
+    description = cursor.description
+    assert cursor.fetchall() == [[i] for i in range(12)]
+    assert cursor.description is description
+
+
+def test_loads_non_standard_json():
+    # Python's json module (used by datasette) may emit `Infinity`
+    resp = httpx.Response(200, content=b'{"rows": [[1.5, Infinity, NaN]]}')
+    assert _loads(resp)["rows"][0][:2] == [1.5, float("inf")]
+
+
+def test_cursor_requests_arrays_shape(url):
+    conn = FakeConnection()
+    cursor = Cursor(conn)
+    cursor.execute("SELECT x FROM t")
+    cursor.fetchall()
+    shapes = [urllib.parse.parse_qs(r[1:])["_shape"] for r in conn.requests]
+    assert shapes == [["arrays"]] * 3
+    # Duplicate column names are kept
+    con = ibis.datasette.connect(url)
+    assert [tuple(r) for r in con.raw_sql("SELECT 1 AS a, 2 AS a")] == [(1, 2)]